@@ -1,7 +1,7 @@
 from django.contrib import admin
 from nested_inlines.admin import NestedModelAdmin, NestedTabularInline, NestedStackedInline
 
-from models import A, B, C
+from example.models import A, B, C
 
 class CInline(NestedTabularInline):
     model = C
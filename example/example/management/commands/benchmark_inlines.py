@@ -0,0 +1,83 @@
+import time
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, models
+from django.forms.widgets import TextInput
+from django.test.client import RequestFactory
+
+from example.admin import AAdmin, BInline
+from example.models import A, B, C
+
+
+class SlowTextInput(TextInput):
+    """
+    Stands in for a widget that waits on I/O while it renders, e.g. one
+    that asks a remote service for its choices or a preview.
+    """
+    delay = 0
+
+    def render(self, *args, **kwargs):
+        time.sleep(self.delay)
+        return super(SlowTextInput, self).render(*args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = ("Compares change_view latency and size of serial, parallel and "
+            "json rendering of the nested inlines, in a throwaway test database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inlines', type=int, default=4,
+                            help='Number of top-level inlines on the change page')
+        parser.add_argument('--rows', type=int, default=20,
+                            help='B rows per A')
+        parser.add_argument('--nested-rows', type=int, default=10,
+                            help='C rows per B')
+        parser.add_argument('--render-delay', type=float, default=0,
+                            help='Milliseconds each B name widget waits while rendering, '
+                                 'to simulate I/O bound rendering')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--workers', type=int, default=None)
+
+    def handle(self, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.benchmark(**options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, **options):
+        user = User.objects.create(username='benchmark', is_staff=True, is_superuser=True)
+        a = A.objects.create(name='benchmark')
+        for i in range(options['rows']):
+            b = B.objects.create(a=a, name='b%d' % i)
+            C.objects.bulk_create(C(b=b, name='c%d' % j)
+                                  for j in range(options['nested_rows']))
+
+        widget = type('SlowTextInput', (SlowTextInput,), {'delay': options['render_delay'] / 1000.0})
+        inline = type('SlowBInline', (BInline,), {
+            'formfield_overrides': {models.CharField: {'widget': widget}},
+        })
+        modes = (
+            ('serial', {}),
+            ('parallel', {'render_inlines_in_parallel': True}),
+            ('json', {'render_inlines_as_json': True}),
+        )
+        for mode, mode_attrs in modes:
+            # the same inline repeated gives several independent top-level subtrees
+            attrs = {'inlines': [inline] * options['inlines'],
+                     'inline_render_workers': options['workers']}
+            attrs.update(mode_attrs)
+            model_admin = type('BenchmarkAdmin', (AAdmin,), attrs)(A, admin.site)
+            timings = []
+            for _ in range(options['repeat']):
+                request = RequestFactory().get('/admin/example/a/%s/' % a.pk)
+                request.user = user
+                start = time.time()
+                response = model_admin.change_view(request, str(a.pk))
+                response.render()
+                timings.append(time.time() - start)
+            self.stdout.write('%-8s best %.3fs  mean %.3fs  (%d bytes)' % (
+                mode, min(timings), sum(timings) / len(timings),
+                len(response.content)))
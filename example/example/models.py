@@ -4,9 +4,9 @@ class A(models.Model):
     name = models.CharField("name", max_length=255)
 
 class B(models.Model):
-    a = models.ForeignKey(A)
+    a = models.ForeignKey(A, on_delete=models.CASCADE)
     name = models.CharField("name", max_length=255)
     
 class C(models.Model):
-    b = models.ForeignKey(B)
+    b = models.ForeignKey(B, on_delete=models.CASCADE)
     name = models.CharField("name", max_length=255)
\ No newline at end of file
@@ -105,6 +105,9 @@ MIDDLEWARE_CLASSES = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Django 1.10 and later
+MIDDLEWARE = MIDDLEWARE_CLASSES
+
 ROOT_URLCONF = 'example.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -116,6 +119,21 @@ TEMPLATE_DIRS = (
     # Don't forget to use absolute paths, not relative paths.
 )
 
+# Django 1.8 and later
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'DIRS': TEMPLATE_DIRS,
+    'APP_DIRS': True,
+    'OPTIONS': {
+        'debug': TEMPLATE_DEBUG,
+        'context_processors': [
+            'django.contrib.auth.context_processors.auth',
+            'django.template.context_processors.request',
+            'django.contrib.messages.context_processors.messages',
+        ],
+    },
+}]
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -1,21 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from django import VERSION as DJANGO_VERSION
 from django.contrib.admin.options import (ModelAdmin, InlineModelAdmin,
-    csrf_protect_m, models, transaction, all_valid,
-    PermissionDenied, unquote, reverse, IS_POPUP_VAR)
+    csrf_protect_m, models, router, transaction, all_valid,
+    PermissionDenied, unquote, reverse, IS_POPUP_VAR, get_content_type_for_model)
 from django.core.exceptions import FieldDoesNotExist
+from django.db import connections
+from django.db.models import prefetch_related_objects
+from django.forms.models import ModelChoiceIterator
 from django.http import Http404
+from django.template.loader import render_to_string
+from django.utils import timezone, translation
 from django.utils.html import escape
 
-from django.contrib.admin.helpers import InlineAdminFormSet, AdminForm
+from django.contrib.admin.helpers import InlineAdminFormSet, AdminForm, AdminReadonlyField
+from django.contrib.admin.utils import flatten_fieldsets, label_for_field
+from django.forms import Media
 from django.utils.translation import gettext as _
 
-from nested_inlines.forms import BaseNestedModelForm, BaseNestedInlineFormSet
-from nested_inlines.helpers import AdminErrorList
+from nested_inlines.forms import (BaseNestedModelForm, BaseNestedInlineFormSet,
+    batch_validate_unique)
+from nested_inlines.helpers import (AdminErrorList, json_script_data,
+    is_simple_widget, get_widget_value)
 
 class NestedModelAdmin(ModelAdmin):
 
     form = BaseNestedModelForm
 
+    # lock the root object row with SELECT ... FOR UPDATE right before saving
+    # a change; only the write phase runs inside a transaction
+    select_for_update_on_save = False
+
+    # render every top-level inline (and its nested subtree) in a thread pool;
+    # inline_render_workers is passed to ThreadPoolExecutor as max_workers.
+    # Only faster when rendering waits on I/O: templates are CPU bound and
+    # on CPython the GIL makes this slower than rendering them serially.
+    # The fragments are rendered before render_change_form completes the
+    # context and without the request, so only inlines with the
+    # stacked/tabular templates of this app are supported (ValueError
+    # otherwise)
+    render_inlines_in_parallel = False
+    inline_render_workers = None
+
+    # send the inlines as json row data plus a schema per inline and let
+    # admin/js/nested_json.js build the rows in the browser. Only inlines
+    # with the stacked/tabular templates of this app and without
+    # prepopulated_fields are supported (ValueError otherwise), and it can't
+    # be combined with render_inlines_in_parallel. inlines.js is not used,
+    # so its added/removed callbacks don't run, and no "View on site" links
+    # are shown
+    render_inlines_as_json = False
+
     class Media:
         css = {'all': ('admin/css/nested.css',)}
         js = ('admin/js/inlines.js',)
@@ -40,7 +75,10 @@ class NestedModelAdmin(ModelAdmin):
         for form in formset.forms:
             if hasattr(form, 'nested_formsets') and form not in deleted_forms:
                 for nested_formset in form.nested_formsets:
-                    self.save_formset(request, form, nested_formset, change)
+                    #a form without post data (e.g. the gap left by a removed
+                    #row) gets unbound nested formsets, there is nothing to save
+                    if nested_formset.is_bound:
+                        self.save_formset(request, form, nested_formset, change)
 
     def add_nested_inline_formsets(self, request, inline, formset, depth=0):
         if depth > 5:
@@ -101,22 +139,290 @@ class NestedModelAdmin(ModelAdmin):
             form.nested_formsets = wrapped_nested_formsets
         return media
 
-    def all_valid_with_nesting(self, formsets):
+    def _prefetch_form_choices(self, form):
+        for field in form.fields.values():
+            widget = field.widget
+            choices = None
+            #RelatedFieldWidgetWrapper copies its choices to the wrapped widget
+            #when it renders, so every level has to get the evaluated list
+            while widget is not None:
+                if isinstance(getattr(widget, 'choices', None), ModelChoiceIterator):
+                    if choices is None:
+                        choices = list(widget.choices)
+                    widget.choices = choices
+                widget = getattr(widget, 'widget', None)
+
+    def prefetch_nested_inline_formsets(self, formsets):
+        """
+        Evaluates everything of the nested formsets that would otherwise hit
+        the database while rendering: the forms (and so the inline querysets),
+        the empty form, the choices of ModelChoiceField widgets, related
+        objects shown as readonly fields and the content type used for the
+        "View on site" links. Readonly callables and __str__ methods that
+        query are not covered and run on the connection of a worker thread.
+        """
+        for formset in formsets:
+            readonly_fields = ()
+            if isinstance(formset, InlineAdminFormSet):
+                readonly_fields = formset.readonly_fields
+                formset = formset.formset
+            get_content_type_for_model(formset.model)
+            empty_form = formset.empty_form
+            self._prefetch_form_choices(empty_form)
+            #picked up by NestedFormSetMixin.empty_form
+            formset._prefetched_empty_form = empty_form
+            instances = []
+            for form in formset.forms:
+                self._prefetch_form_choices(form)
+                if form.instance.pk is not None:
+                    instances.append(form.instance)
+                if hasattr(form, 'nested_formsets'):
+                    self.prefetch_nested_inline_formsets(form.nested_formsets)
+            for name in readonly_fields:
+                try:
+                    field = formset.model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    continue
+                if field.is_relation and instances:
+                    prefetch_related_objects(instances, name)
+
+    def render_inline_formsets_in_parallel(self, request, context):
+        """
+        Renders the template of each top-level inline admin formset in a
+        thread pool and stores the html as its ``prerendered`` attribute,
+        which the edit_inline templates output instead of rendering again.
+        The context lacks the request and the keys render_change_form adds,
+        so custom templates, which might use them, are rejected.
+        """
+        inline_admin_formsets = context['inline_admin_formsets']
+        def check_templates(inlines):
+            for inline in inlines:
+                if inline.template not in (NestedStackedInline.template, NestedTabularInline.template):
+                    raise ValueError('render_inlines_in_parallel does not support the custom template %r of %s'
+                                     % (inline.template, type(inline).__name__))
+                check_templates(inline.get_inline_instances(request))
+        check_templates(inline_admin_formset.opts for inline_admin_formset in inline_admin_formsets)
+        self.prefetch_nested_inline_formsets(inline_admin_formsets)
+        #translation and timezone activation are thread local
+        language = translation.get_language()
+        current_timezone = timezone.get_current_timezone()
+        count = len(inline_admin_formsets)
+
+        def render(index):
+            inline_admin_formset = inline_admin_formsets[index]
+            fragment_context = dict(context)
+            fragment_context.update({
+                'inline_admin_formset': inline_admin_formset,
+                #the templates look at the loop of admin/change_form.html
+                'forloop': {
+                    'counter0': index,
+                    'counter': index + 1,
+                    'first': index == 0,
+                    'last': index == count - 1,
+                },
+            })
+            try:
+                with translation.override(language), timezone.override(current_timezone):
+                    return render_to_string(inline_admin_formset.opts.template, fragment_context)
+            finally:
+                #anything still querying got its own connection in this thread
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.inline_render_workers) as executor:
+            fragments = list(executor.map(render, range(count)))
+        for inline_admin_formset, fragment in zip(inline_admin_formsets, fragments):
+            inline_admin_formset.prerendered = fragment
+
+    def get_nested_inline_schema(self, request, inline, formset, fieldsets, readonly, schemas, key):
+        """
+        Adds the schema of an inline and of its nested inlines to schemas.
+        The widgets are rendered once from the empty form of formset, whose
+        prefix is the template the client fills in for every row. Nested
+        inlines get the prefix '__parent__-<default prefix>'.
+        """
+        if inline.template not in (NestedStackedInline.template, NestedTabularInline.template):
+            raise ValueError('render_inlines_as_json does not support the custom template %r of %s'
+                             % (inline.template, type(inline).__name__))
+        if inline.get_prepopulated_fields(request):
+            raise ValueError('render_inlines_as_json does not support the prepopulated_fields of %s'
+                             % type(inline).__name__)
+        form = formset.empty_form
+        names = flatten_fieldsets(fieldsets)
+        fields = []
+        for name in names + [n for n in form.fields if n not in names]:
+            if name in readonly:
+                fields.append({
+                    'name': name,
+                    'label': label_for_field(name, inline.model, inline),
+                    'readonly': True,
+                })
+            elif name in form.fields:
+                bound_field = form[name]
+                fields.append({
+                    'name': name,
+                    'label': bound_field.label,
+                    'required': bound_field.field.required,
+                    'help_text': bound_field.help_text,
+                    'hidden': bound_field.is_hidden,
+                    'simple': is_simple_widget(bound_field.field.widget),
+                    'widget': str(bound_field),
+                })
+        schema = {
+            'prefix': formset.prefix,
+            'stacked': inline.template == NestedStackedInline.template,
+            'verbose_name': inline.verbose_name,
+            'verbose_name_plural': inline.verbose_name_plural,
+            'can_delete': formset.can_delete,
+            'min_num': getattr(formset, 'min_num', 0),
+            'max_num': formset.max_num,
+            'fields': fields,
+            'inlines': [],
+        }
+        schemas[key] = schema
+        for index, nested_inline in enumerate(inline.get_inline_instances(request)):
+            InlineFormSet = nested_inline.get_formset(request)
+            prefix = "__parent__-%s" % InlineFormSet.get_default_prefix()
+            nested_formset = InlineFormSet(instance=inline.model(), prefix=prefix,
+                                           queryset=nested_inline.get_queryset(request))
+            nested_key = "%s.%s" % (key, index)
+            schema['inlines'].append(nested_key)
+            self.get_nested_inline_schema(request, nested_inline, nested_formset,
+                list(nested_inline.get_fieldsets(request)),
+                list(nested_inline.get_readonly_fields(request)),
+                schemas, nested_key)
+
+    def get_nested_inline_data(self, request, inline_admin_formset, schemas, key):
+        """
+        Returns the rows of a wrapped formset and its nested formsets.
+        A formset is {'s': schema key, 'p': prefix, 't': total forms,
+        'i': initial forms, 'e': non form errors, 'r': rows} and a row is
+        {'v': values in schema field order, 'e': {field index: errors},
+        'ne': non field errors, 'o': original, 'n': nested formsets}.
+        """
+        formset = inline_admin_formset.formset
+        schema = schemas[key]
+        rows = []
+        for form in formset.forms:
+            values = []
+            errors = {}
+            for index, field in enumerate(schema['fields']):
+                name = field['name']
+                if field.get('readonly'):
+                    values.append(AdminReadonlyField(form, name, False,
+                        model_admin=inline_admin_formset.opts).contents())
+                    continue
+                if field['simple']:
+                    values.append(get_widget_value(form[name]))
+                else:
+                    values.append(str(form[name]))
+                if name in form.errors:
+                    errors[index] = list(form.errors[name])
+            row = {'v': values}
+            if errors:
+                row['e'] = errors
+            if form.non_field_errors():
+                row['ne'] = list(form.non_field_errors())
+            if form.instance.pk:
+                row['o'] = str(form.instance)
+            if hasattr(form, 'nested_formsets'):
+                row['n'] = [self.get_nested_inline_data(request, nested, schemas, nested_key)
+                            for nested_key, nested in zip(schema['inlines'], form.nested_formsets)]
+            rows.append(row)
+        return {
+            's': key,
+            'p': formset.prefix,
+            't': formset.total_form_count(),
+            'i': formset.initial_form_count(),
+            'e': list(formset.non_form_errors()),
+            'r': rows,
+        }
+
+    def render_inline_formsets_as_json(self, request, context):
+        """
+        Replaces the html of each top-level inline by its nested tree as json
+        data, which admin/js/nested_json.js renders in the browser. The
+        submitted form is the same as in html mode.
+        """
+        if self.render_inlines_in_parallel:
+            raise ValueError('render_inlines_as_json and render_inlines_in_parallel '
+                             'can not be used together')
+        for index, inline_admin_formset in enumerate(context['inline_admin_formsets']):
+            schemas = {}
+            key = str(index)
+            self.get_nested_inline_schema(request, inline_admin_formset.opts,
+                inline_admin_formset.formset, inline_admin_formset.fieldsets,
+                inline_admin_formset.readonly_fields, schemas, key)
+            data = {
+                'schemas': schemas,
+                'formset': self.get_nested_inline_data(request, inline_admin_formset, schemas, key),
+            }
+            inline_admin_formset.prerendered = render_to_string('admin/edit_inline/nested_json.html', {
+                'prefix': inline_admin_formset.formset.prefix,
+                'data': json_script_data(data),
+            })
+        context['media'] = context['media'] + Media(js=['admin/js/nested_json.js'])
+
+    def validate_unique_with_nesting(self, formsets):
+        """
+        Runs batch_validate_unique level by level, once for the sibling
+        formsets of each model that have batch_unique_validation set.
+        Formsets under forms marked for deletion are skipped.
+        """
+        def opted_in(formsets):
+            return any(getattr(formset, 'batch_unique_validation', False) or
+                       any(opted_in(getattr(form, 'nested_formsets', ())) for form in formset.forms)
+                       for formset in formsets)
+        #walking the levels cleans every form, which is only needed if
+        #some formset of the tree batches its unique checks
+        if not opted_in(formsets):
+            return
+        level = [formset for formset in formsets if formset.is_bound]
+        while level:
+            siblings = {}
+            for formset in level:
+                if getattr(formset, 'batch_unique_validation', False):
+                    siblings.setdefault(formset.model, []).append(formset)
+            for model_formsets in siblings.values():
+                batch_validate_unique(model_formsets)
+            nested_level = []
+            for formset in level:
+                for form in formset.forms:
+                    if not hasattr(form, 'nested_formsets'):
+                        continue
+                    #_should_delete_form needs the cleaned_data of the form
+                    form.errors
+                    if formset.can_delete and formset._should_delete_form(form):
+                        continue
+                    nested_level.extend(f for f in form.nested_formsets if f.is_bound)
+            level = nested_level
+
+    def all_valid_with_nesting(self, formsets, depth=0):
         """Recursively validate all nested formsets
         """
+        if depth == 0:
+            self.validate_unique_with_nesting(formsets)
         if not all_valid([i for i in formsets if i.is_bound]):
             return False
         for formset in formsets:
             if not formset.is_bound:
-                pass
+                continue
             for form in formset:
                 if hasattr(form, 'nested_formsets'):
-                    if not self.all_valid_with_nesting(form.nested_formsets):
+                    if not self.all_valid_with_nesting(form.nested_formsets, depth=depth+1):
                         return False
         return True
 
+    def lock_object(self, request, obj):
+        """
+        Lock the row of the root object with SELECT ... FOR UPDATE until the
+        write transaction of change_view ends, when select_for_update_on_save
+        is set. It only takes the lock, the object that is saved is still the
+        one built from the submitted form.
+        """
+        using = router.db_for_write(self.model, instance=obj)
+        self.model._default_manager.using(using).select_for_update().get(pk=obj.pk)
+
     @csrf_protect_m
-    @transaction.atomic
     def add_view(self, request, form_url='', extra_context=None):
         "The 'add' admin view for this model."
         model = self.model
@@ -150,15 +456,16 @@ class NestedModelAdmin(ModelAdmin):
                 if inline.inlines:
                     self.add_nested_inline_formsets(request, inline, formset)
             if self.all_valid_with_nesting(formsets) and form_validated:
-                self.save_model(request, new_object, form, False)
-                self.save_related(request, form, formsets, False)
+                with transaction.atomic(using=router.db_for_write(self.model)):
+                    self.save_model(request, new_object, form, False)
+                    self.save_related(request, form, formsets, False)
 
-                if DJANGO_VERSION < (1, 9):
-                    change_message = self.construct_change_message(request, form, formsets)
-                    self.log_addition(request, new_object)
-                else:
-                    change_message = self.construct_change_message(request, form, formsets, True)
-                    self.log_addition(request, new_object, change_message)
+                    if DJANGO_VERSION < (1, 9):
+                        change_message = self.construct_change_message(request, form, formsets)
+                        self.log_addition(request, new_object)
+                    else:
+                        change_message = self.construct_change_message(request, form, formsets, True)
+                        self.log_addition(request, new_object, change_message)
 
                 return self.response_add(request, new_object)
         else:
@@ -218,10 +525,13 @@ class NestedModelAdmin(ModelAdmin):
             'django_version_lt_1_6': DJANGO_VERSION < (1, 6)
         }
         context.update(extra_context or {})
+        if self.render_inlines_as_json:
+            self.render_inline_formsets_as_json(request, context)
+        elif self.render_inlines_in_parallel:
+            self.render_inline_formsets_in_parallel(request, context)
         return self.render_change_form(request, context, form_url=form_url, add=True)
 
     @csrf_protect_m
-    @transaction.atomic
     def change_view(self, request, object_id, form_url='', extra_context=None):
         "The 'change' admin view for this model."
         model = self.model
@@ -268,10 +578,13 @@ class NestedModelAdmin(ModelAdmin):
                     self.add_nested_inline_formsets(request, inline, formset)
 
             if self.all_valid_with_nesting(formsets) and form_validated:
-                self.save_model(request, new_object, form, True)
-                self.save_related(request, form, formsets, True)
-                change_message = self.construct_change_message(request, form, formsets)
-                self.log_change(request, new_object, change_message)
+                with transaction.atomic(using=router.db_for_write(self.model, instance=new_object)):
+                    if self.select_for_update_on_save:
+                        self.lock_object(request, new_object)
+                    self.save_model(request, new_object, form, True)
+                    self.save_related(request, form, formsets, True)
+                    change_message = self.construct_change_message(request, form, formsets)
+                    self.log_change(request, new_object, change_message)
                 return self.response_change(request, new_object)
 
         else:
@@ -322,6 +635,10 @@ class NestedModelAdmin(ModelAdmin):
             'django_version_lt_1_6': DJANGO_VERSION < (1, 6)
         }
         context.update(extra_context or {})
+        if self.render_inlines_as_json:
+            self.render_inline_formsets_as_json(request, context)
+        elif self.render_inlines_in_parallel:
+            self.render_inline_formsets_in_parallel(request, context)
         return self.render_change_form(request, context, change=True, obj=obj, form_url=form_url)
 
     def _get_formsets(self, request, obj=None):
@@ -1,6 +1,119 @@
+from collections import defaultdict
+
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.db import connection, connections, router
+from django.db.models import Case, IntegerField, Max, Q, Value, When
 from django.forms.forms import BaseForm, ErrorDict
 from django.forms.models import ModelForm, BaseInlineFormSet
 
+def _unique_lookup(instance, unique_check):
+    """
+    Returns the values to look up for a unique check of an instance, or None
+    if the check is skipped, the same way Model._perform_unique_checks does.
+    """
+    values = []
+    for field_name in unique_check:
+        f = instance._meta.get_field(field_name)
+        value = getattr(instance, f.attname)
+        if value is None or (value == '' and connection.features.interprets_empty_strings_as_nulls):
+            return None
+        if f.primary_key and not instance._state.adding:
+            return None
+        values.append(value)
+    return tuple(values)
+
+def _row_data(formset, form, unique_check, parents):
+    # like BaseModelFormSet.validate_unique, except that the foreign key to
+    # the parent is identified by the parent, which differs between formsets
+    row_data = []
+    for field in unique_check:
+        if field not in form.cleaned_data:
+            continue
+        if field == formset.fk.name:
+            row_data.append(parents[formset])
+            continue
+        d = form.cleaned_data[field]
+        if hasattr(d, '_get_pk_val'):
+            d = d._get_pk_val()
+        elif isinstance(d, list):
+            d = tuple(d)
+        row_data.append(d)
+    return tuple(row_data)
+
+def batch_validate_unique(formsets):
+    """
+    Validates the unique and unique_together constraints of the forms of
+    formsets with batch_unique_validation against the database, with one
+    query per constraint for all of them, and finds duplicates between the
+    formsets. Duplicates within one formset are left to its validate_unique.
+    The database flags the conflicting rows itself, so values it compares
+    differently than python does (collations, coerced types) are caught.
+
+    The formsets are the siblings of a nesting level, e.g. the formsets of
+    one nested inline under all the rows of its parent formset. This has to
+    run before the formsets themselves are validated.
+    """
+    lookups = defaultdict(list)
+    for formset in formsets:
+        formset._unique_validated = True
+        formset._batched_unique_errors = []
+        for form in formset.forms:
+            #form.errors cleans the form, which collects its unique checks
+            form.errors
+            if formset.can_delete and formset._should_delete_form(form):
+                continue
+            for model_class, unique_check in getattr(form, '_unique_checks', ()):
+                lookup = _unique_lookup(form.instance, unique_check)
+                if lookup is not None:
+                    lookups[(model_class, unique_check)].append((form, lookup))
+
+    for (model_class, unique_check), rows in lookups.items():
+        using = router.db_for_read(model_class)
+        #each row is looked up twice, in the filter and in its conflict flag
+        batch_size = connections[using].ops.bulk_batch_size(unique_check * 2 + ('pk',), rows) or len(rows)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            query = Q()
+            flags = {}
+            for index, (form, lookup) in enumerate(batch):
+                row_query = Q(**dict(zip(unique_check, lookup)))
+                query |= row_query
+                if not form.instance._state.adding:
+                    row_query &= ~Q(pk=form.instance._get_pk_val(model_class._meta))
+                flags['row%s' % index] = Max(Case(When(row_query, then=Value(1)),
+                                                  default=Value(0), output_field=IntegerField()))
+            conflicts = model_class._default_manager.using(using).filter(query).aggregate(**flags)
+            for index, (form, lookup) in enumerate(batch):
+                if conflicts['row%s' % index]:
+                    key = unique_check[0] if len(unique_check) == 1 else NON_FIELD_ERRORS
+                    error = form.instance.unique_error_message(model_class, unique_check)
+                    form._update_errors(ValidationError({key: [error]}))
+
+    #identify the parent of each formset, new parents by the object itself
+    parents = dict((formset, ('pk', formset.instance.pk) if formset.instance.pk is not None
+                    else ('new', id(formset.instance)))
+                   for formset in formsets)
+    #formset.deleted_forms would validate the formset before the errors are in
+    valid_forms = [(formset, form) for formset in formsets for form in formset.forms
+                   if form.is_valid() and not (formset.can_delete and formset._should_delete_form(form))]
+    all_unique_checks = set()
+    for formset, form in valid_forms:
+        all_unique_checks.update(getattr(form, '_unique_checks', ()))
+    for model_class, unique_check in all_unique_checks:
+        seen_data = {}
+        for formset, form in valid_forms:
+            row_data = _row_data(formset, form, unique_check, parents)
+            if not row_data or None in row_data:
+                continue
+            seen_in = seen_data.setdefault(row_data, formset)
+            if seen_in is formset:
+                continue
+            formset._batched_unique_errors.append(formset.get_unique_error_message(unique_check))
+            form._errors[NON_FIELD_ERRORS] = formset.error_class([formset.get_form_error()])
+            for field in unique_check:
+                if field in form.cleaned_data:
+                    del form.cleaned_data[field]
+
 class NestedFormMixin(object):
     def full_clean(self):
         """
@@ -15,10 +128,24 @@ class NestedFormMixin(object):
         # changed from the initial data, short circuit any validation.
         if self.empty_permitted and not self.has_changed() and not self.dependency_has_changed():
             return
+        # An extra form without any submitted data, e.g. the gap left by a
+        # row removed in the browser, is left alone as well; its fields
+        # may differ from their initial values but it can't be corrected.
+        if self.empty_permitted and not self.has_submitted_data():
+            return
         self._clean_fields()
         self._clean_form()
         self._post_clean()
 
+    def has_submitted_data(self):
+        """
+        Returns true, if the data holds any value with the prefix of this
+        form, including the ones of its nested formsets.
+        """
+        prefix = self.add_prefix('')
+        return any(key.startswith(prefix) for key in self.data) or \
+            any(key.startswith(prefix) for key in self.files)
+
     def dependency_has_changed(self):
         """
         Returns true, if any dependent form has changed.
@@ -30,6 +157,37 @@ class BaseNestedForm(NestedFormMixin, BaseForm):
     pass
 
 class NestedFormSetMixin(object):
+    # check the unique constraints of all forms with one query per constraint,
+    # see batch_validate_unique
+    batch_unique_validation = False
+
+    def _construct_form(self, i, **kwargs):
+        form = super(NestedFormSetMixin, self)._construct_form(i, **kwargs)
+        form._batch_unique_validation = self.batch_unique_validation
+        return form
+
+    @property
+    def empty_form(self):
+        # NestedModelAdmin evaluates the empty form up front when it renders
+        # the inlines in parallel, see prefetch_nested_inline_formsets
+        form = getattr(self, '_prefetched_empty_form', None)
+        if form is None:
+            form = super(NestedFormSetMixin, self).empty_form
+        return form
+
+    def validate_unique(self):
+        if not self.batch_unique_validation:
+            return super(NestedFormSetMixin, self).validate_unique()
+        if not getattr(self, '_unique_validated', False):
+            batch_validate_unique([self])
+        errors = list(self._batched_unique_errors)
+        try:
+            super(NestedFormSetMixin, self).validate_unique()
+        except ValidationError as e:
+            errors.extend(e.error_list)
+        if errors:
+            raise ValidationError(errors)
+
     def save_new_objects(self, commit=True):
         # same as django's except in case when a form is not changed but the
         # instance itself is not saved yet, we are not skipping saving
@@ -52,6 +210,10 @@ class NestedFormSetMixin(object):
         return self.new_objects
 
     def dependency_has_changed(self):
+        # an unbound formset has no submitted changes, its extra forms only
+        # look changed if their fields have initial values
+        if not self.is_bound:
+            return False
         for form in self.forms:
             if form.has_changed() or form.dependency_has_changed():
                 return True
@@ -61,6 +223,19 @@ class BaseNestedInlineFormSet(NestedFormSetMixin, BaseInlineFormSet):
     pass
 
 class NestedModelFormMixin(NestedFormMixin):
+    def validate_unique(self):
+        """
+        Leaves the unique checks to batch_validate_unique if the formset asks
+        for it and only checks unique_for_date and friends here.
+        """
+        if not getattr(self, '_batch_unique_validation', False):
+            return super(NestedModelFormMixin, self).validate_unique()
+        exclude = self._get_validation_exclusions()
+        self._unique_checks, date_checks = self.instance._get_unique_checks(exclude=exclude)
+        errors = self.instance._perform_date_checks(date_checks)
+        if errors:
+            self._update_errors(ValidationError(errors))
+
     def dependency_has_changed(self):
         # check for the nested_formsets attribute, added by the admin app.
         # TODO this should be generalized
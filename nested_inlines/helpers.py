@@ -1,5 +1,52 @@
+import json
+
 import django.contrib.admin.helpers
 from django.contrib.admin.helpers import InlineAdminFormSet
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.widgets import CheckboxInput, FileInput, MultipleHiddenInput, MultiWidget
+from django.utils.safestring import mark_safe
+
+_json_script_escapes = {
+    ord('>'): '\\u003E',
+    ord('<'): '\\u003C',
+    ord('&'): '\\u0026',
+}
+
+def json_script_data(data):
+    """
+    Dumps data as compact json that is safe to put in a <script> element.
+    """
+    dumped = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return mark_safe(dumped.translate(_json_script_escapes))
+
+def _unwrap_widget(widget):
+    #admin wraps related widgets in a RelatedFieldWidgetWrapper
+    while hasattr(widget, 'widget'):
+        widget = widget.widget
+    return widget
+
+def is_simple_widget(widget):
+    """
+    Returns True if the value of the widget can be set on the client by
+    changing the inputs of its empty-form html, instead of sending the html
+    rendered for each row.
+    """
+    return not isinstance(_unwrap_widget(widget), (MultiWidget, FileInput, MultipleHiddenInput))
+
+def get_widget_value(bound_field):
+    """
+    Returns the value of a bound field the way its widget would render it:
+    a bool for checkboxes, a list of strings for choice widgets and a string
+    for everything else.
+    """
+    widget = _unwrap_widget(bound_field.field.widget)
+    value = bound_field.value()
+    if isinstance(widget, CheckboxInput):
+        return bool(widget.check_test(value))
+    value = widget.format_value(value)
+    if value is None:
+        return ''
+    return value
 
 class AdminErrorList(django.contrib.admin.helpers.AdminErrorList):
     """
@@ -0,0 +1,275 @@
+/**
+ * Django admin nested inlines, json mode
+ *
+ * Renders the inlines of a NestedModelAdmin with render_inlines_as_json.
+ * The server sends a schema per inline, holding the widgets rendered once
+ * from the empty form, and the nested tree as row values. Every row is
+ * built here with its final prefix, so the submitted data is the same as
+ * with the html templates and no prefixes have to be rewritten.
+ */
+(function($) {
+	function title(text) {
+		return text.replace(/(^|\s)\S/g, function(c) { return c.toUpperCase(); });
+	}
+
+	function capfirst(text) {
+		return text.charAt(0).toUpperCase() + text.slice(1);
+	}
+
+	function errorList(errors) {
+		if (!errors || !errors.length) {
+			return $();
+		}
+		var list = $('<ul class="errorlist"/>');
+		$.each(errors, function(i, error) {
+			$('<li/>').text(error).appendTo(list);
+		});
+		return list;
+	}
+
+	// Set the value of every input of a widget rendered from the empty form
+	function setValue(holder, value) {
+		holder.find('input, select, textarea').each(function() {
+			var input = $(this);
+			if (input.is(':checkbox, :radio')) {
+				if (typeof value === 'boolean') {
+					input.prop('checked', value);
+				} else {
+					input.prop('checked', $.inArray(input.val(), [].concat(value)) !== -1);
+				}
+			} else if (!input.is(':file')) {
+				input.val(value);
+			}
+		});
+	}
+
+	function renderField(schema, fieldIndex, formPrefix, row) {
+		var field = schema.fields[fieldIndex];
+		var value = row ? row.v[fieldIndex] : '';
+		var holder = $('<div/>');
+		if (field.readonly) {
+			return $('<p/>').html(value);
+		}
+		if (row && !field.simple) {
+			// the server sent the html of this row
+			return holder.html(value).contents();
+		}
+		holder.html(field.widget.split(schema.prefix + '-__prefix__').join(formPrefix));
+		if (row) {
+			setValue(holder, value);
+		}
+		return holder.contents();
+	}
+
+	function reinitWidgets(options) {
+		// Reinitialize the calendar and clock widgets by force
+		if (typeof DateTimeShortcuts != "undefined") {
+			$(".datetimeshortcuts").remove();
+			DateTimeShortcuts.init();
+		}
+		if (typeof SelectFilter != "undefined") {
+			$(".selectfilter, .selectfilterstacked").each(function(index, value) {
+				var namearr = value.name.split('-');
+				SelectFilter.init(value.id, namearr[namearr.length - 1], $(value).hasClass('selectfilterstacked'), options.adminStaticPrefix);
+			});
+		}
+	}
+
+	function renderFormset(payload, data, options, parentPrefix) {
+		var schema = payload.schemas[data.s];
+		var visible = [], hidden = [], deleteIndex = -1;
+		$.each(schema.fields, function(i, field) {
+			if (field.name == 'DELETE') {
+				deleteIndex = i;
+			} else if (field.hidden) {
+				hidden.push(i);
+			} else {
+				visible.push(i);
+			}
+		});
+		var columns = visible.length + 1 + (schema.can_delete ? 1 : 0);
+		var liveRows = 0;
+
+		var group = $('<div class="inline-group"/>').attr('id', data.p + '-group');
+		if (parentPrefix) {
+			group.addClass(parentPrefix + '-nested-inline nested-inline');
+		}
+		var management = {TOTAL_FORMS: data.t, INITIAL_FORMS: data.i,
+			MIN_NUM_FORMS: schema.min_num, MAX_NUM_FORMS: schema.max_num};
+		$.each(management, function(name, value) {
+			$('<input type="hidden"/>').attr({name: data.p + '-' + name, id: 'id_' + data.p + '-' + name})
+				.val(value === null ? '' : value).appendTo(group);
+		});
+		var total = group.children('#id_' + data.p + '-TOTAL_FORMS');
+
+		var rowContainer, addButton;
+		var addLink = $('<a href="javascript:void(0)"/>').text(options.addText.replace('__verbose_name__', title(schema.verbose_name)));
+		if (schema.stacked) {
+			group.append($('<h2/>').text(title(schema.verbose_name_plural)), errorList(data.e));
+			rowContainer = group;
+			addButton = $('<div class="add-row"/>').append(addLink);
+			group.append(addButton);
+		} else {
+			var head = $('<tr/>');
+			$.each(visible, function(i, fieldIndex) {
+				var field = schema.fields[fieldIndex];
+				var th = $('<th/>').text(capfirst(field.label)).toggleClass('required', !!field.required);
+				if (i === 0) {
+					th.attr('colspan', 2);
+				}
+				head.append(th);
+			});
+			if (schema.can_delete) {
+				head.append($('<th/>').text(options.deleteLabel));
+			}
+			rowContainer = $('<tbody/>');
+			addButton = $('<tr class="add-row"/>').append($('<td/>').attr('colspan', columns).append(addLink));
+			rowContainer.append(addButton);
+			group.append($('<div class="tabular inline-related"/>').append(
+				$('<fieldset class="module"/>').append(
+					$('<h2/>').text(capfirst(schema.verbose_name_plural)),
+					errorList(data.e),
+					$('<table/>').append($('<thead/>').append(head), rowContainer))));
+		}
+
+		function updateAddButton() {
+			addButton.toggle(schema.max_num === null || liveRows < schema.max_num);
+		}
+
+		function removeLink(elements) {
+			return $('<a href="javascript:void(0)"/>').addClass('inline-deletelink').text(options.deleteText).click(function(e) {
+				e.preventDefault();
+				// TOTAL_FORMS is left as is, so later rows keep their prefix:
+				// the missing index is an extra form without any data, which
+				// the server skips (see NestedFormMixin.has_submitted_data)
+				elements.remove();
+				liveRows -= 1;
+				updateAddButton();
+			});
+		}
+
+		function renderNested(formPrefix, row) {
+			var groups = [];
+			$.each(schema.inlines, function(j, key) {
+				var nestedData = row && row.n ? row.n[j] : {
+					s: key, p: payload.schemas[key].prefix.split('__parent__').join(formPrefix),
+					t: 0, i: 0, e: [], r: []
+				};
+				groups.push(renderFormset(payload, nestedData, options, data.p));
+			});
+			return groups;
+		}
+
+		function buildRow(index, row) {
+			var formPrefix = data.p + '-' + index;
+			var isNew = index >= data.i;
+			var errors = row && row.e ? row.e : {};
+			var nested = renderNested(formPrefix, row);
+			var elements;
+			if (schema.stacked) {
+				var label = row && row.o ? row.o : '#' + (index + 1);
+				var h3 = $('<h3/>').append($('<b/>').text(title(schema.verbose_name) + ':'), ' ',
+					$('<span class="inline_label"/>').text(label));
+				if (schema.can_delete && !isNew && deleteIndex != -1) {
+					h3.append($('<span class="delete"/>').append(
+						renderField(schema, deleteIndex, formPrefix, row), ' ',
+						$('<label/>').attr('for', 'id_' + formPrefix + '-DELETE').text(options.deleteLabel)));
+				}
+				var fieldset = $('<fieldset class="module aligned"/>');
+				$.each(visible, function(i, fieldIndex) {
+					var field = schema.fields[fieldIndex];
+					var label = $('<label/>').text(capfirst(field.label) + ':').toggleClass('required', !!field.required);
+					if (!field.readonly) {
+						label.attr('for', 'id_' + formPrefix + '-' + field.name);
+					}
+					var line = $('<div/>').append(label, renderField(schema, fieldIndex, formPrefix, row));
+					if (field.help_text) {
+						line.append($('<div class="help"/>').html(field.help_text));
+					}
+					fieldset.append($('<div class="form-row"/>').addClass('field-' + field.name).append(errorList(errors[fieldIndex]), line));
+				});
+				$.each(hidden, function(i, fieldIndex) {
+					fieldset.append(renderField(schema, fieldIndex, formPrefix, row));
+				});
+				elements = $('<div class="inline-related"/>').attr('id', formPrefix).addClass('dynamic-' + data.p)
+					.append(h3, errorList(row && row.ne), fieldset);
+				$.each(nested, function(i, nestedGroup) {
+					elements.append(nestedGroup, '<div class="nested-inline-bottom-border"></div>');
+				});
+				if (isNew) {
+					h3.append($('<span/>').append(removeLink(elements)));
+				}
+			} else {
+				var tr = $('<tr class="form-row"/>').attr('id', formPrefix).addClass('dynamic-' + data.p)
+					.addClass(data.p + '-not-nested').toggleClass('no-bottom-border', nested.length > 0);
+				var original = $('<td class="original"/>').appendTo(tr);
+				if (row && row.o) {
+					original.append($('<p/>').text(row.o));
+				}
+				$.each(hidden, function(i, fieldIndex) {
+					original.append(renderField(schema, fieldIndex, formPrefix, row));
+				});
+				$.each(visible, function(i, fieldIndex) {
+					$('<td/>').addClass('field-' + schema.fields[fieldIndex].name)
+						.append(errorList(errors[fieldIndex]), renderField(schema, fieldIndex, formPrefix, row)).appendTo(tr);
+				});
+				if (schema.can_delete) {
+					var deleteCell = $('<td class="delete"/>').appendTo(tr);
+					if (!isNew && deleteIndex != -1) {
+						deleteCell.append(renderField(schema, deleteIndex, formPrefix, row));
+					}
+				}
+				// keep the rows in order, jQuery's add() sorts detached nodes
+				var rows = [tr[0]];
+				if (row && row.ne && row.ne.length) {
+					rows.unshift($('<tr/>').append($('<td/>').attr('colspan', columns).append(errorList(row.ne)))[0]);
+				}
+				$.each(nested, function(i, nestedGroup) {
+					rows.push($('<tr class="nested-inline-row"/>').toggleClass('no-bottom-border', i < nested.length - 1)
+						.append($('<td/>').attr('colspan', columns).append(nestedGroup))[0]);
+				});
+				elements = $(rows);
+				if (isNew) {
+					tr.children(':last').append($('<div/>').append(removeLink(elements)));
+				}
+			}
+			return elements;
+		}
+
+		function addRow() {
+			var index = parseInt(total.val(), 10);
+			total.val(index + 1);
+			addButton.before(buildRow(index, null));
+			liveRows += 1;
+			updateAddButton();
+		}
+
+		$.each(data.r, function(index, row) {
+			addButton.before(buildRow(index, row));
+			liveRows += 1;
+		});
+		while (liveRows < schema.min_num) {
+			addRow();
+		}
+		updateAddButton();
+		addLink.click(function(e) {
+			e.preventDefault();
+			addRow();
+			reinitWidgets(options);
+		});
+		return group;
+	}
+
+	$.fn.nestedJsonFormset = function(payload, opts) {
+		var options = $.extend({}, $.fn.nestedJsonFormset.defaults, opts);
+		this.replaceWith(renderFormset(payload, payload.formset, options, null));
+		return this;
+	};
+
+	$.fn.nestedJsonFormset.defaults = {
+		addText : "Add another __verbose_name__",
+		deleteText : "Remove",
+		deleteLabel : "Delete?",
+		adminStaticPrefix : "/static/admin/"
+	};
+})(django.jQuery);
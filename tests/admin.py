@@ -0,0 +1,22 @@
+from django.contrib import admin
+
+from nested_inlines.admin import NestedModelAdmin, NestedStackedInline, NestedTabularInline
+
+from tests.models import A, B, C
+
+
+class CInline(NestedTabularInline):
+    model = C
+
+
+class BInline(NestedStackedInline):
+    model = B
+    inlines = [CInline]
+    readonly_fields = ['tag']
+
+
+class AAdmin(NestedModelAdmin):
+    inlines = [BInline]
+
+
+admin.site.register(A, AAdmin)
@@ -0,0 +1,12 @@
+import os
+
+import django
+
+
+def pytest_configure():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    DiscoverRunner(verbosity=0).setup_databases()
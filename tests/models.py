@@ -0,0 +1,36 @@
+from django.db import models
+
+
+class LowerCaseCharField(models.CharField):
+    """Stored lower case, so the database compares it case insensitively."""
+    def get_prep_value(self, value):
+        value = super(LowerCaseCharField, self).get_prep_value(value)
+        return value.lower() if value else value
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=255)
+
+    def __str__(self):
+        return self.name
+
+
+class A(models.Model):
+    name = models.CharField(max_length=255)
+
+
+class B(models.Model):
+    a = models.ForeignKey(A, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    tag = models.ForeignKey(Tag, null=True, blank=True, on_delete=models.SET_NULL)
+
+
+class C(models.Model):
+    b = models.ForeignKey(B, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    code = models.CharField(max_length=10, blank=True)
+    ref = LowerCaseCharField(max_length=10, unique=True, null=True, blank=True)
+    tag = models.ForeignKey(Tag, null=True, blank=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        unique_together = [('b', 'code')]
@@ -0,0 +1,231 @@
+import json
+import re
+import threading
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.test import TestCase, TransactionTestCase
+
+from tests.models import A, B, C, Tag
+
+
+class NestedAdminMixin(object):
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(user)
+        self.model_admin = admin.site._registry[A]
+        self.a = A.objects.create(name='a')
+        # only exists inside the transaction of the test
+        self.tag = Tag.objects.create(name='tag-in-transaction')
+        self.b = B.objects.create(a=self.a, name='b', tag=self.tag)
+        self.c = C.objects.create(b=self.b, name='c', code='c')
+        self.change_url = '/admin/tests/a/%s/change/' % self.a.pk
+
+
+class NestedAdminTestCase(NestedAdminMixin, TestCase):
+    pass
+
+
+class TransactionTests(NestedAdminMixin, TransactionTestCase):
+    def change_data(self, name):
+        return {
+            'name': name,
+            'b_set-TOTAL_FORMS': '1', 'b_set-INITIAL_FORMS': '1',
+            'b_set-0-id': self.b.pk, 'b_set-0-a': self.a.pk, 'b_set-0-name': 'b',
+            'b_set-0-c_set-TOTAL_FORMS': '1', 'b_set-0-c_set-INITIAL_FORMS': '1',
+            'b_set-0-c_set-0-id': self.c.pk, 'b_set-0-c_set-0-b': self.b.pk,
+            'b_set-0-c_set-0-name': 'c', 'b_set-0-c_set-0-code': 'c',
+        }
+
+    def test_pages_rendered_outside_a_transaction(self):
+        in_atomic_block = []
+        render_change_form = self.model_admin.render_change_form
+
+        def record(*args, **kwargs):
+            in_atomic_block.append(connection.in_atomic_block)
+            return render_change_form(*args, **kwargs)
+
+        with mock.patch.object(self.model_admin, 'render_change_form', record):
+            self.assertEqual(self.client.get(self.change_url).status_code, 200)
+            self.assertEqual(self.client.get('/admin/tests/a/add/').status_code, 200)
+            response = self.client.post(self.change_url, self.change_data(''))
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post('/admin/tests/a/add/', {'name': '', 'b_set-TOTAL_FORMS': '0',
+                                                                'b_set-INITIAL_FORMS': '0'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(in_atomic_block, [False] * 4)
+
+    def test_failing_save_related_rolls_back_save_model(self):
+        with mock.patch.object(self.model_admin, 'save_related', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(self.change_url, self.change_data('renamed'))
+        self.assertEqual(A.objects.get(pk=self.a.pk).name, 'a')
+
+    def test_object_locked_inside_the_write_transaction(self):
+        in_atomic_block = []
+        lock_object = self.model_admin.lock_object
+
+        def record(request, obj):
+            in_atomic_block.append(connection.in_atomic_block)
+            return lock_object(request, obj)
+
+        with mock.patch.object(self.model_admin, 'select_for_update_on_save', True), \
+                mock.patch.object(self.model_admin, 'lock_object', side_effect=record) as lock:
+            response = self.client.post(self.change_url, self.change_data('renamed'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(in_atomic_block, [True])
+        self.assertEqual(lock.call_args[0][1].pk, self.a.pk)
+        self.assertEqual(A.objects.get(pk=self.a.pk).name, 'renamed')
+
+
+class ParallelRenderingTests(NestedAdminTestCase):
+    def test_same_page_without_worker_connections(self):
+        serial = self.client.get(self.change_url)
+
+        threads = set()
+        ensure_connection = BaseDatabaseWrapper.ensure_connection
+
+        def record_thread(connection):
+            threads.add(threading.current_thread())
+            return ensure_connection(connection)
+
+        with mock.patch.object(self.model_admin, 'render_inlines_in_parallel', True), \
+                mock.patch.object(BaseDatabaseWrapper, 'ensure_connection', record_thread):
+            parallel = self.client.get(self.change_url)
+
+        self.assertEqual(threads, set([threading.current_thread()]))
+        # the selects of all nested rows, the empty forms and the readonly tag
+        count = serial.content.count(self.tag.name.encode())
+        self.assertGreater(count, 2)
+        self.assertEqual(parallel.content.count(self.tag.name.encode()), count)
+
+    def test_custom_templates_rejected(self):
+        from tests.admin import BInline, CInline
+        with mock.patch.object(self.model_admin, 'render_inlines_in_parallel', True):
+            for inline in (BInline, CInline):
+                with mock.patch.object(inline, 'template', 'custom/stacked.html'):
+                    with self.assertRaises(ValueError):
+                        self.client.get(self.change_url)
+
+
+class RemovedRowTests(NestedAdminTestCase):
+    def test_gap_left_by_a_removed_row(self):
+        # nested_json.js leaves a gap in the indexes when a new row is removed
+        data = {
+            'name': 'a',
+            'b_set-TOTAL_FORMS': '3', 'b_set-INITIAL_FORMS': '1',
+            'b_set-0-id': self.b.pk, 'b_set-0-a': self.a.pk, 'b_set-0-name': 'b',
+            'b_set-0-c_set-TOTAL_FORMS': '1', 'b_set-0-c_set-INITIAL_FORMS': '1',
+            'b_set-0-c_set-0-id': self.c.pk, 'b_set-0-c_set-0-b': self.b.pk,
+            'b_set-0-c_set-0-name': 'c', 'b_set-0-c_set-0-code': 'c',
+            'b_set-2-a': self.a.pk, 'b_set-2-name': 'new b',
+            'b_set-2-c_set-TOTAL_FORMS': '1', 'b_set-2-c_set-INITIAL_FORMS': '0',
+            'b_set-2-c_set-0-name': 'new c',
+        }
+        response = self.client.post(self.change_url, data)
+        self.assertEqual(response.status_code, 302)
+        new_b = B.objects.get(name='new b')
+        self.assertEqual(list(new_b.c_set.values_list('name', flat=True)), ['new c'])
+        self.assertEqual(B.objects.count(), 2)
+
+    def test_gap_left_by_a_removed_row_with_nested_defaults(self):
+        # the unbound nested formsets of the gap have changed extra forms
+        code = C._meta.get_field('code')
+        data = {
+            'name': 'a',
+            'b_set-TOTAL_FORMS': '3', 'b_set-INITIAL_FORMS': '1',
+            'b_set-0-id': self.b.pk, 'b_set-0-a': self.a.pk, 'b_set-0-name': 'b',
+            'b_set-0-c_set-TOTAL_FORMS': '1', 'b_set-0-c_set-INITIAL_FORMS': '1',
+            'b_set-0-c_set-0-id': self.c.pk, 'b_set-0-c_set-0-b': self.b.pk,
+            'b_set-0-c_set-0-name': 'c', 'b_set-0-c_set-0-code': 'c',
+            'b_set-2-a': self.a.pk, 'b_set-2-name': 'new b',
+            'b_set-2-c_set-TOTAL_FORMS': '1', 'b_set-2-c_set-INITIAL_FORMS': '0',
+            'b_set-2-c_set-0-name': 'new c', 'b_set-2-c_set-0-code': 'zz',
+        }
+        with mock.patch.object(code, 'default', 'zz'):
+            response = self.client.post(self.change_url, data)
+        self.assertEqual(response.status_code, 302)
+        new_b = B.objects.get(name='new b')
+        self.assertEqual(list(new_b.c_set.values_list('name', 'code')), [('new c', 'zz')])
+        self.assertEqual(B.objects.count(), 2)
+
+
+class JsonRenderingTests(NestedAdminTestCase):
+    def json_payload(self, response):
+        match = re.search(r'<script type="application/json" id="b_set-json">(.*?)</script>',
+                          response.content.decode(), re.S)
+        return json.loads(match.group(1))
+
+    def test_rows_sent_as_json(self):
+        self.c.tag = self.tag
+        self.c.save()
+        with mock.patch.object(self.model_admin, 'render_inlines_as_json', True):
+            response = self.client.get(self.change_url)
+        self.assertContains(response, 'admin/js/nested_json.js')
+        self.assertNotContains(response, 'stackedFormset')
+        payload = self.json_payload(response)
+
+        b_schema = payload['schemas'][payload['formset']['s']]
+        self.assertTrue(b_schema['stacked'])
+        self.assertEqual([field['name'] for field in b_schema['fields']], ['a', 'name', 'tag', 'id', 'DELETE'])
+        self.assertIn('name="b_set-__prefix__-name"', b_schema['fields'][1]['widget'])
+        self.assertEqual(b_schema['fields'][2], {'name': 'tag', 'label': 'tag', 'readonly': True})
+        c_schema = payload['schemas'][b_schema['inlines'][0]]
+        self.assertFalse(c_schema['stacked'])
+        self.assertEqual(c_schema['prefix'], '__parent__-c_set')
+        self.assertEqual([field['name'] for field in c_schema['fields']],
+                         ['b', 'name', 'code', 'ref', 'tag', 'id', 'DELETE'])
+        self.assertIn('name="__parent__-c_set-__prefix__-tag"', c_schema['fields'][4]['widget'])
+
+        # the saved row and three extra forms
+        formset = payload['formset']
+        self.assertEqual((formset['p'], formset['t'], formset['i']), ('b_set', 4, 1))
+        b_row = formset['r'][0]
+        self.assertEqual(b_row['v'], [str(self.a.pk), 'b', 'tag-in-transaction', str(self.b.pk), False])
+        c_set = b_row['n'][0]
+        self.assertEqual((c_set['p'], c_set['t'], c_set['i']), ('b_set-0-c_set', 4, 1))
+        self.assertEqual(c_set['r'][0]['v'], [str(self.b.pk), 'c', 'c', '', [str(self.tag.pk)], str(self.c.pk), False])
+        self.assertEqual(c_set['r'][1]['v'], [str(self.b.pk), '', '', '', [''], '', False])
+        self.assertEqual([row['n'][0]['p'] for row in formset['r'][1:]],
+                         ['b_set-1-c_set', 'b_set-2-c_set', 'b_set-3-c_set'])
+
+    def test_errors_sent_as_json(self):
+        data = {
+            'name': 'a',
+            'b_set-TOTAL_FORMS': '1', 'b_set-INITIAL_FORMS': '1',
+            'b_set-0-id': self.b.pk, 'b_set-0-a': self.a.pk, 'b_set-0-name': '',
+            'b_set-0-c_set-TOTAL_FORMS': '2', 'b_set-0-c_set-INITIAL_FORMS': '1',
+            'b_set-0-c_set-0-id': self.c.pk, 'b_set-0-c_set-0-b': self.b.pk,
+            'b_set-0-c_set-0-name': '', 'b_set-0-c_set-0-code': 'c',
+            'b_set-0-c_set-1-name': 'new c', 'b_set-0-c_set-1-code': 'new',
+            'b_set-0-c_set-1-tag': self.tag.pk, 'b_set-0-c_set-1-DELETE': 'on',
+        }
+        with mock.patch.object(self.model_admin, 'render_inlines_as_json', True):
+            response = self.client.post(self.change_url, data)
+        self.assertEqual(response.status_code, 200)
+        formset = self.json_payload(response)['formset']
+        self.assertEqual((formset['t'], formset['i']), (1, 1))
+        b_row = formset['r'][0]
+        self.assertEqual(b_row['e'], {'1': ['This field is required.']})
+        self.assertEqual(b_row['v'][1], '')
+        c_set = b_row['n'][0]
+        self.assertEqual((c_set['t'], c_set['i']), (2, 1))
+        self.assertEqual(c_set['r'][0]['e'], {'1': ['This field is required.']})
+        # the submitted values are sent back
+        self.assertEqual(c_set['r'][1]['v'], ['', 'new c', 'new', '', [str(self.tag.pk)], '', True])
+
+    def test_unsupported_configurations(self):
+        from tests.admin import BInline, CInline
+        with mock.patch.object(self.model_admin, 'render_inlines_as_json', True):
+            with mock.patch.object(self.model_admin, 'render_inlines_in_parallel', True):
+                with self.assertRaises(ValueError):
+                    self.client.get(self.change_url)
+            with mock.patch.object(CInline, 'template', 'custom/tabular.html'):
+                with self.assertRaises(ValueError):
+                    self.client.get(self.change_url)
+            with mock.patch.object(BInline, 'prepopulated_fields', {'name': ['name']}):
+                with self.assertRaises(ValueError):
+                    self.client.get(self.change_url)
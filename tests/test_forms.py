@@ -0,0 +1,99 @@
+from unittest import mock
+
+from django.db import connection
+from django.forms.models import inlineformset_factory
+from django.test.utils import CaptureQueriesContext
+
+from nested_inlines.forms import BaseNestedInlineFormSet, BaseNestedModelForm, batch_validate_unique
+from tests.admin import CInline
+from tests.models import B, C
+from tests.test_admin import NestedAdminTestCase
+
+
+class BatchFormSet(BaseNestedInlineFormSet):
+    batch_unique_validation = True
+
+
+CFormSet = inlineformset_factory(B, C, form=BaseNestedModelForm, formset=BatchFormSet,
+                                 fields=['name', 'code', 'ref'])
+PlainCFormSet = inlineformset_factory(B, C, form=BaseNestedModelForm, formset=BaseNestedInlineFormSet,
+                                      fields=['name', 'code', 'ref'])
+
+
+def c_data(*rows):
+    data = {'c_set-TOTAL_FORMS': str(len(rows)), 'c_set-INITIAL_FORMS': '0'}
+    for i, (code, ref) in enumerate(rows):
+        data['c_set-%s-name' % i] = 'c%s' % i
+        data['c_set-%s-code' % i] = code
+        data['c_set-%s-ref' % i] = ref
+    return data
+
+
+def unique_queries(queries):
+    return [q for q in queries if q['sql'].startswith('SELECT') and 'FROM "tests_c"' in q['sql']]
+
+
+class BatchUniqueValidationTests(NestedAdminTestCase):
+    def test_conflict_with_existing_row(self):
+        rows = [('code%s' % i, '') for i in range(30)] + [('c', '')]
+        formset = CFormSet(c_data(*rows), instance=self.b)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(formset.is_valid())
+        self.assertEqual(len(unique_queries(queries)), 1)
+        self.assertEqual(formset.errors[-1]['__all__'], ['C with this B and Code already exists.'])
+        self.assertEqual([errors for errors in formset.errors[:-1] if errors], [])
+
+    def test_database_match_that_differs_in_python(self):
+        C.objects.create(b=self.b, name='r', code='r', ref='ABC')
+        formset = CFormSet(c_data(('x', 'Abc'), ('y', 'other')), instance=self.b)
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.errors[0]['ref'], ['C with this Ref already exists.'])
+        self.assertEqual(formset.errors[1], {})
+
+        # one row equal to the stored value, another only equal in the database
+        formset = CFormSet(c_data(('x', 'abc'), ('y', 'Abc')), instance=self.b)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(formset.is_valid())
+        # one per constraint, ref and (b, code)
+        self.assertEqual(len(unique_queries(queries)), 2)
+        self.assertEqual(formset.errors[0]['ref'], ['C with this Ref already exists.'])
+        self.assertEqual(formset.errors[1]['ref'], ['C with this Ref already exists.'])
+
+    def test_duplicates_under_different_parents(self):
+        other_b = B.objects.create(a=self.a, name='other b')
+        data = {
+            'name': 'a',
+            'b_set-TOTAL_FORMS': '2', 'b_set-INITIAL_FORMS': '2',
+            'b_set-0-id': self.b.pk, 'b_set-0-a': self.a.pk, 'b_set-0-name': 'b',
+            'b_set-0-c_set-TOTAL_FORMS': '1', 'b_set-0-c_set-INITIAL_FORMS': '0',
+            'b_set-0-c_set-0-name': 'new', 'b_set-0-c_set-0-code': 'x', 'b_set-0-c_set-0-ref': 'dup',
+            'b_set-1-id': other_b.pk, 'b_set-1-a': self.a.pk, 'b_set-1-name': 'other b',
+            'b_set-1-c_set-TOTAL_FORMS': '1', 'b_set-1-c_set-INITIAL_FORMS': '0',
+            'b_set-1-c_set-0-name': 'new', 'b_set-1-c_set-0-code': 'x', 'b_set-1-c_set-0-ref': 'dup',
+        }
+        with mock.patch.object(CInline, 'formset', BatchFormSet):
+            response = self.client.post(self.change_url, data)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Please correct the duplicate data for ref.', response.context['errors'])
+            self.assertFalse(C.objects.filter(ref='dup').exists())
+
+            # the same code under different parents is fine for unique_together
+            data['b_set-1-c_set-0-ref'] = 'other'
+            response = self.client.post(self.change_url, data)
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual(C.objects.filter(code='x').count(), 2)
+
+    def test_new_parent_apart_from_saved_parents(self):
+        new_b = B(a=self.a, name='new b')
+        # a saved parent whose pk happens to be the id() of the new one
+        other_b = B.objects.create(pk=id(new_b), a=self.a, name='other b')
+        formsets = [CFormSet(c_data(('x', '')), instance=new_b),
+                    CFormSet(c_data(('x', '')), instance=other_b)]
+        batch_validate_unique(formsets)
+        self.assertEqual([formset._batched_unique_errors for formset in formsets], [[], []])
+
+    def test_nothing_cleaned_without_batching(self):
+        formset = PlainCFormSet(c_data(('x', '')), instance=self.b)
+        formset.forms[0].nested_formsets = []
+        self.model_admin.validate_unique_with_nesting([formset])
+        self.assertIsNone(formset.forms[0]._errors)